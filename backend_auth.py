@@ -5,9 +5,15 @@ JWT token, parol xavfsizligi
 
 from datetime import datetime, timedelta
 from typing import Optional
+from uuid import UUID
 from jose import JWTError, jwt
-from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from cachetools import TLRUCache
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+import bcrypt
+import hashlib
+import time
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 import os
@@ -19,16 +25,46 @@ from models import Librarian
 load_dotenv()
 
 # Parol hashing sozlamalari
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# PASSWORD_HASH_SCHEME: yangi hashlar uchun "bcrypt" yoki "argon2"
+# (tekshirishda sxema hash prefiksidan aniqlanadi: $2b$ / $argon2id$)
+PASSWORD_HASH_SCHEME = os.getenv("PASSWORD_HASH_SCHEME", "bcrypt")
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+argon2_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
 
 # OAuth2 sozlamalari
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
+class BearerTokenScheme(OAuth2PasswordBearer):
+    """
+    OAuth2PasswordBearer (OpenAPI sxemasi o'zgarmaydi), lekin
+    Authorization headeri oddiy prefiks tekshiruvi bilan o'qiladi
+    """
+    async def __call__(self, request: Request) -> Optional[str]:
+        authorization = request.headers.get("Authorization")
+        if not authorization or authorization[:7].lower() != "bearer ":
+            if self.auto_error:
+                raise HTTPException(
+                    status_code=status.HTTP_401_UNAUTHORIZED,
+                    detail="Not authenticated",
+                    headers={"WWW-Authenticate": "Bearer"},
+                )
+            return None
+        return authorization[7:]
+
+oauth2_scheme = BearerTokenScheme(tokenUrl="/api/auth/login")
 
 # JWT sozlamalari
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-this-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24  # 24 soat
 
+# Tekshirilgan tokenlar keshi: token hash -> (Librarian, exp)
+# Yozuv TOKEN_CACHE_TTL soniyadan yoki token muddatidan oldin o'chadi
+TOKEN_CACHE_TTL = 60
+_token_cache = TLRUCache(
+    maxsize=10_000,
+    ttu=lambda _key, value, now: min(now + TOKEN_CACHE_TTL, value[1]),
+    timer=time.time
+)
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """
     Parolni tekshirish
@@ -38,7 +74,13 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     Returns:
         bool: Agar parol to'g'ri bo'lsa True
     """
-    return pwd_context.verify(plain_password, hashed_password)
+    if hashed_password.startswith("$argon2"):
+        try:
+            return argon2_hasher.verify(hashed_password, plain_password)
+        except (VerificationError, InvalidHashError):
+            return False
+    
+    return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
 
 def get_password_hash(password: str) -> str:
     """
@@ -48,7 +90,10 @@ def get_password_hash(password: str) -> str:
     Returns:
         str: Hashed parol
     """
-    return pwd_context.hash(password)
+    if PASSWORD_HASH_SCHEME == "argon2":
+        return argon2_hasher.hash(password)
+    
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """
@@ -71,12 +116,92 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     
     return encoded_jwt
 
+def _credentials_exception() -> HTTPException:
+    """401 xatolik (noto'g'ri yoki muddati o'tgan token)"""
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Autentifikatsiya ma'lumotlarini tekshirib bo'lmadi",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+def _inactive_exception() -> HTTPException:
+    """403 xatolik (foydalanuvchi faol emas)"""
+    return HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
+        detail="Foydalanuvchi faol emas"
+    )
+
+def decode_access_token(token: str) -> dict:
+    """
+    JWT tokenni tekshirish va payload ni olish
+    Args:
+        token: JWT access token
+    Returns:
+        dict: Token payload
+    Raises:
+        HTTPException: Agar token noto'g'ri bo'lsa
+    """
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise _credentials_exception()
+    
+    if payload.get("sub") is None:
+        raise _credentials_exception()
+    
+    return payload
+
 async def get_current_user(
+    token: str = Depends(oauth2_scheme)
+) -> Librarian:
+    """
+    JWT token dan joriy foydalanuvchini olish
+    Foydalanuvchi bazadan emas, token claim laridan tiklanadi
+    (sessiyaga bog'lanmagan Librarian obyekti). Rol o'zgarishi yoki
+    faolsizlantirish bu yerda token muddati tugaguncha sezilmaydi -
+    admin operatsiyalari get_current_admin orqali bazadan tekshiriladi
+    Args:
+        token: JWT access token
+    Returns:
+        Librarian: Joriy foydalanuvchi
+    Raises:
+        HTTPException: Agar token noto'g'ri yoki foydalanuvchi faol bo'lmasa
+    """
+    # Keshdan olish (jwt.decode talab qilinmaydi)
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    cached = _token_cache.get(cache_key)
+    if cached is not None:
+        return cached[0]
+    
+    payload = decode_access_token(token)
+    
+    # Eski tokenlarda role claim i yo'q - qayta login kerak
+    if "role" not in payload:
+        raise _credentials_exception()
+    
+    try:
+        user_id = UUID(payload["sub"])
+    except ValueError:
+        raise _credentials_exception()
+    
+    # Token faqat faol foydalanuvchiga beriladi (login tekshiradi)
+    user = Librarian(
+        librarian_id=user_id,
+        full_name=payload.get("full_name"),
+        role=payload["role"],
+        is_active=True
+    )
+    _token_cache[cache_key] = (user, payload["exp"])
+    
+    return user
+
+def get_current_user_db(
     token: str = Depends(oauth2_scheme),
     db: Session = Depends(get_db)
 ) -> Librarian:
     """
-    JWT token dan joriy foydalanuvchini olish
+    Joriy foydalanuvchini bazadan olish
+    Faqat to'liq Librarian qatori kerak bo'lgan endpointlar uchun
     Args:
         token: JWT access token
         db: Database session
@@ -85,42 +210,26 @@ async def get_current_user(
     Raises:
         HTTPException: Agar token noto'g'ri yoki foydalanuvchi topilmasa
     """
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Autentifikatsiya ma'lumotlarini tekshirib bo'lmadi",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    
-    try:
-        # Tokenni decode qilish
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        
-        if user_id is None:
-            raise credentials_exception
-            
-    except JWTError:
-        raise credentials_exception
+    user_id = decode_access_token(token)["sub"]
     
     # Foydalanuvchini bazadan olish
     user = db.query(Librarian).filter(Librarian.librarian_id == user_id).first()
     
     if user is None:
-        raise credentials_exception
+        raise _credentials_exception()
     
     if not user.is_active:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Foydalanuvchi faol emas"
-        )
+        raise _inactive_exception()
     
     return user
 
-async def get_current_admin(
-    current_user: Librarian = Depends(get_current_user)
+def get_current_admin(
+    current_user: Librarian = Depends(get_current_user_db)
 ) -> Librarian:
     """
     Faqat admin foydalanuvchilar uchun
+    Rol va faollik bazadan tekshiriladi (token claim lariga ishonilmaydi),
+    shuning uchun admin huquqini olib tashlash darhol kuchga kiradi
     Args:
         current_user: Joriy foydalanuvchi
     Returns:
@@ -142,11 +251,12 @@ def create_default_admin(db: Session):
     Email: admin@library.uz
     Password: admin123
     """
-    existing_admin = db.query(Librarian).filter(
-        Librarian.email == "admin@library.uz"
-    ).first()
+    admin_exists = db.query(
+        db.query(Librarian).filter(Librarian.email == "admin@library.uz").exists()
+    ).scalar()
     
-    if not existing_admin:
+    # Parol faqat yangi admin yaratilganda hash qilinadi
+    if not admin_exists:
         admin = Librarian(
             full_name="Admin Adminov",
             email="admin@library.uz",
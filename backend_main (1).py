@@ -3,12 +3,16 @@ Kutubxona Boshqaruv Tizimi - Backend API
 FastAPI asosida ishlab chiqilgan
 """
 
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Response, status, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from datetime import datetime, timedelta
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend
+import os
 import uvicorn
 
 from database import get_db, engine, Base
@@ -19,8 +23,11 @@ from auth import (
     get_password_hash, 
     create_access_token, 
     get_current_user,
+    get_current_user_db,
     get_current_admin
 )
+from utils import orm_to_dict, fetch_page, like_pattern, log_action, audit_listener, LIKE_ESCAPE
+from routes import invalidate_stats_cache
 
 # Ma'lumotlar bazasi jadvallarini yaratish
 Base.metadata.create_all(bind=engine)
@@ -31,9 +38,23 @@ app = FastAPI(
     description="To'liq funktsional kutubxona boshqaruv tizimi",
     version="1.0.0",
     docs_url="/api/docs",
-    redoc_url="/api/redoc"
+    redoc_url="/api/redoc",
+    default_response_class=ORJSONResponse  # Tezroq JSON serializatsiya
 )
 
+# Kesh sozlamalari (REDIS_URL berilsa Redis, aks holda xotirada)
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    from redis import asyncio as aioredis
+    from fastapi_cache.backends.redis import RedisBackend
+    FastAPICache.init(RedisBackend(aioredis.from_url(REDIS_URL)), prefix="lib-cache")
+else:
+    FastAPICache.init(InMemoryBackend(), prefix="lib-cache")
+
+# Audit loglari navbatini ilova ishlayotgan vaqtda alohida oqim chiqaradi
+app.add_event_handler("startup", audit_listener.start)
+app.add_event_handler("shutdown", audit_listener.stop)
+
 # CORS sozlamalari (Frontend bilan ishlash uchun)
 app.add_middleware(
     CORSMiddleware,
@@ -41,6 +62,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Total-Count"],
 )
 
 # =====================================================
@@ -48,7 +70,7 @@ app.add_middleware(
 # =====================================================
 
 @app.post("/api/auth/login", response_model=Token)
-async def login(
+def login(
     form_data: OAuth2PasswordRequestForm = Depends(),
     db: Session = Depends(get_db)
 ):
@@ -74,7 +96,11 @@ async def login(
         )
     
     access_token = create_access_token(
-        data={"sub": str(librarian.librarian_id), "role": librarian.role}
+        data={
+            "sub": str(librarian.librarian_id),
+            "role": librarian.role,
+            "full_name": librarian.full_name
+        }
     )
     
     return {
@@ -90,7 +116,7 @@ async def login(
 
 @app.get("/api/auth/me", response_model=LibrarianResponse)
 async def get_current_user_info(
-    current_user: Librarian = Depends(get_current_user)
+    current_user: Librarian = Depends(get_current_user_db)
 ):
     """Joriy foydalanuvchi ma'lumotlari"""
     return current_user
@@ -100,7 +126,8 @@ async def get_current_user_info(
 # =====================================================
 
 @app.get("/api/members", response_model=List[MemberResponse])
-async def get_members(
+def get_members(
+    response: Response,
     skip: int = 0,
     limit: int = 100,
     search: Optional[str] = None,
@@ -110,22 +137,24 @@ async def get_members(
     """
     Barcha a'zolarni olish
     Qidiruv: ism, email, telefon bo'yicha
+    Umumiy son X-Total-Count headerida qaytariladi
     """
     query = db.query(Member)
     
     if search:
-        search_filter = f"%{search}%"
+        search_filter = like_pattern(search)
         query = query.filter(
-            (Member.full_name.ilike(search_filter)) |
-            (Member.email.ilike(search_filter)) |
-            (Member.phone.ilike(search_filter))
+            (Member.full_name.ilike(search_filter, escape=LIKE_ESCAPE)) |
+            (Member.email.ilike(search_filter, escape=LIKE_ESCAPE)) |
+            (Member.phone.ilike(search_filter, escape=LIKE_ESCAPE))
         )
     
-    members = query.offset(skip).limit(limit).all()
+    members, total = fetch_page(query, skip, limit)
+    response.headers["X-Total-Count"] = str(total)
     return members
 
 @app.get("/api/members/{member_id}", response_model=MemberDetailResponse)
-async def get_member(
+def get_member(
     member_id: str,
     db: Session = Depends(get_db),
     current_user: Librarian = Depends(get_current_user)
@@ -139,15 +168,13 @@ async def get_member(
     borrowings = db.query(Borrowing).filter(Borrowing.member_id == member_id).all()
     penalties = db.query(Penalty).filter(Penalty.member_id == member_id).all()
     
-    return {
-        **member.__dict__,
-        "borrowings": borrowings,
-        "penalties": penalties
-    }
+    # Ichki ORM ro'yxatlari response_model da from_attributes bilan tekshiriladi
+    return orm_to_dict(member, borrowings=borrowings, penalties=penalties)
 
 @app.post("/api/members", response_model=MemberResponse, status_code=status.HTTP_201_CREATED)
-async def create_member(
+def create_member(
     member: MemberCreate,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: Librarian = Depends(get_current_user)
 ):
@@ -161,12 +188,14 @@ async def create_member(
     db.add(db_member)
     db.commit()
     db.refresh(db_member)
+    background_tasks.add_task(invalidate_stats_cache)
     return db_member
 
 @app.put("/api/members/{member_id}", response_model=MemberResponse)
-async def update_member(
+def update_member(
     member_id: str,
     member: MemberUpdate,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: Librarian = Depends(get_current_user)
 ):
@@ -181,11 +210,15 @@ async def update_member(
     
     db.commit()
     db.refresh(db_member)
+    # is_active o'zgarsa total_members ham o'zgaradi
+    if 'is_active' in update_data:
+        background_tasks.add_task(invalidate_stats_cache)
     return db_member
 
 @app.delete("/api/members/{member_id}")
-async def delete_member(
+def delete_member(
     member_id: str,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: Librarian = Depends(get_current_admin)
 ):
@@ -196,6 +229,8 @@ async def delete_member(
     
     db.delete(member)
     db.commit()
+    background_tasks.add_task(invalidate_stats_cache)
+    log_action("delete_member", str(current_user.librarian_id), {"member_id": member_id})
     return {"message": "A'zo muvaffaqiyatli o'chirildi"}
 
 # =====================================================
@@ -203,7 +238,8 @@ async def delete_member(
 # =====================================================
 
 @app.get("/api/books", response_model=List[BookResponse])
-async def get_books(
+def get_books(
+    response: Response,
     skip: int = 0,
     limit: int = 100,
     search: Optional[str] = None,
@@ -215,14 +251,15 @@ async def get_books(
     Barcha kitoblarni olish
     Qidiruv: nomi, muallif bo'yicha
     Filter: janr, mavjudlik
+    Umumiy son X-Total-Count headerida qaytariladi
     """
     query = db.query(Book).filter(Book.is_active == True)
     
     if search:
-        search_filter = f"%{search}%"
+        search_filter = like_pattern(search)
         query = query.filter(
-            (Book.title.ilike(search_filter)) |
-            (Book.author.ilike(search_filter))
+            (Book.title.ilike(search_filter, escape=LIKE_ESCAPE)) |
+            (Book.author.ilike(search_filter, escape=LIKE_ESCAPE))
         )
     
     if genre:
@@ -231,11 +268,12 @@ async def get_books(
     if available_only:
         query = query.filter(Book.available_copies > 0)
     
-    books = query.offset(skip).limit(limit).all()
+    books, total = fetch_page(query, skip, limit)
+    response.headers["X-Total-Count"] = str(total)
     return books
 
 @app.get("/api/books/{book_id}", response_model=BookDetailResponse)
-async def get_book(
+def get_book(
     book_id: str,
     db: Session = Depends(get_db)
 ):
@@ -249,10 +287,7 @@ async def get_book(
         Borrowing.book_id == book_id
     ).scalar()
     
-    return {
-        **book.__dict__,
-        "total_borrowed": borrow_count
-    }
+    return orm_to_dict(book, total_borrowed=borrow_count)
 
 # Routes moduldan barcha endpointlarni import qilish
 from routes import router
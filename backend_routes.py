@@ -3,9 +3,11 @@ To'liq API Endpoints
 Barcha CRUD operatsiyalar va biznes logika
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
-from sqlalchemy.orm import Session
-from sqlalchemy import func, desc, and_
+from fastapi import APIRouter, Depends, HTTPException, Response, status, BackgroundTasks
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import func, desc, and_, update
+from fastapi_cache import FastAPICache
+from fastapi_cache.decorator import cache
 from typing import List, Optional
 from datetime import datetime, date, timedelta
 from uuid import UUID
@@ -14,16 +16,41 @@ from database import get_db
 from models import *
 from schemas import *
 from auth import get_current_user, get_current_admin
+from utils import (
+    orm_to_dict, fetch_page, log_action,
+    ACTIVE_BORROWING_STATUSES, BORROWING_BORROWED, BORROWING_RETURNED,
+    PENALTY_PAID, PENALTY_UNPAID, BorrowingStatus, PenaltyStatus
+)
 
 router = APIRouter()
 
+# Statistika keshi (dashboard lar tez-tez so'raydi)
+STATS_CACHE_NAMESPACE = "stats"
+STATS_CACHE_EXPIRE = 30  # soniya
+
+def stats_key_builder(func, namespace: str = "", request=None, response=None, args=(), kwargs=None) -> str:
+    """
+    Statistika kesh kaliti
+    db hisobga olinmaydi, faqat qolgan argumentlar (limit)
+    """
+    params = sorted((k, v) for k, v in (kwargs or {}).items() if k != "db")
+    return f"{FastAPICache.get_prefix()}:{namespace}:{func.__name__}:{params}"
+
+async def invalidate_stats_cache():
+    """
+    Kitob, a'zo, ijara va jarimalar o'zgarganda statistika keshini tozalash
+    (sync endpointlardan BackgroundTasks orqali chaqiriladi)
+    """
+    await FastAPICache.clear(namespace=STATS_CACHE_NAMESPACE)
+
 # =====================================================
 # BOOKS ENDPOINTS (To'liq)
 # =====================================================
 
 @router.post("/api/books", response_model=BookResponse, status_code=status.HTTP_201_CREATED)
-async def create_book(
+def create_book(
     book: BookCreate,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: Librarian = Depends(get_current_user)
 ):
@@ -38,12 +65,14 @@ async def create_book(
     db.add(db_book)
     db.commit()
     db.refresh(db_book)
+    background_tasks.add_task(invalidate_stats_cache)
     return db_book
 
 @router.put("/api/books/{book_id}", response_model=BookResponse)
-async def update_book(
+def update_book(
     book_id: str,
     book: BookUpdate,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: Librarian = Depends(get_current_user)
 ):
@@ -66,11 +95,15 @@ async def update_book(
     
     db.commit()
     db.refresh(db_book)
+    # is_active o'zgarsa total_books ham o'zgaradi
+    if 'is_active' in update_data:
+        background_tasks.add_task(invalidate_stats_cache)
     return db_book
 
 @router.delete("/api/books/{book_id}")
-async def delete_book(
+def delete_book(
     book_id: str,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: Librarian = Depends(get_current_admin)
 ):
@@ -82,7 +115,7 @@ async def delete_book(
     # Aktiv borrowinglar bo'lsa o'chirib bo'lmaydi
     active_borrowings = db.query(Borrowing).filter(
         Borrowing.book_id == book_id,
-        Borrowing.status.in_(['borrowed', 'late'])
+        Borrowing.status.in_(ACTIVE_BORROWING_STATUSES)
     ).count()
     
     if active_borrowings > 0:
@@ -93,10 +126,12 @@ async def delete_book(
     
     db.delete(book)
     db.commit()
+    background_tasks.add_task(invalidate_stats_cache)
+    log_action("delete_book", str(current_user.librarian_id), {"book_id": book_id})
     return {"message": "Kitob muvaffaqiyatli o'chirildi"}
 
 @router.get("/api/books/genres", response_model=List[str])
-async def get_genres(db: Session = Depends(get_db)):
+def get_genres(db: Session = Depends(get_db)):
     """Barcha janrlar ro'yxati"""
     genres = db.query(Book.genre).distinct().filter(Book.genre.isnot(None)).all()
     return [g[0] for g in genres]
@@ -106,10 +141,11 @@ async def get_genres(db: Session = Depends(get_db)):
 # =====================================================
 
 @router.get("/api/borrowings", response_model=List[BorrowingDetailResponse])
-async def get_borrowings(
+def get_borrowings(
+    response: Response,
     skip: int = 0,
     limit: int = 100,
-    status_filter: Optional[str] = None,
+    status_filter: Optional[BorrowingStatus] = None,
     member_id: Optional[str] = None,
     book_id: Optional[str] = None,
     db: Session = Depends(get_db),
@@ -118,8 +154,12 @@ async def get_borrowings(
     """
     Barcha ijaralarni olish
     Filter: status, member_id, book_id
+    Umumiy son X-Total-Count headerida qaytariladi
     """
-    query = db.query(Borrowing).join(Member).join(Book)
+    query = db.query(Borrowing).options(
+        joinedload(Borrowing.member),
+        joinedload(Borrowing.book)
+    )
     
     if status_filter:
         query = query.filter(Borrowing.status == status_filter)
@@ -130,26 +170,29 @@ async def get_borrowings(
     if book_id:
         query = query.filter(Borrowing.book_id == book_id)
     
-    borrowings = query.order_by(desc(Borrowing.borrow_date)).offset(skip).limit(limit).all()
+    borrowings, total = fetch_page(query.order_by(desc(Borrowing.borrow_date)), skip, limit)
+    response.headers["X-Total-Count"] = str(total)
     
     # Ma'lumotlarni to'ldirish
+    today = date.today()
     result = []
     for b in borrowings:
         days_late = None
-        if b.status in ['borrowed', 'late'] and b.due_date < date.today():
-            days_late = (date.today() - b.due_date).days
+        if b.status in ACTIVE_BORROWING_STATUSES and b.due_date < today:
+            days_late = (today - b.due_date).days
         
-        result.append({
-            **b.__dict__,
-            "member_name": b.member.full_name,
-            "book_title": b.book.title,
-            "days_late": days_late
-        })
+        # Oddiy dict - validatsiya faqat response_model da bir marta bajariladi
+        result.append(orm_to_dict(
+            b,
+            member_name=b.member.full_name,
+            book_title=b.book.title,
+            days_late=days_late
+        ))
     
     return result
 
 @router.post("/api/borrowings", response_model=BorrowingResponse, status_code=status.HTTP_201_CREATED)
-async def create_borrowing(
+def create_borrowing(
     borrowing: BorrowingCreate,
     background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
@@ -159,14 +202,6 @@ async def create_borrowing(
     Kitobni ijaraga berish
     Validatsiya: kitob mavjudmi, a'zo faolmi
     """
-    # Kitob mavjudligini tekshirish
-    book = db.query(Book).filter(Book.book_id == borrowing.book_id).first()
-    if not book:
-        raise HTTPException(status_code=404, detail="Kitob topilmadi")
-    
-    if book.available_copies <= 0:
-        raise HTTPException(status_code=400, detail="Bu kitobning mavjud nusxalari yo'q")
-    
     # A'zo faolligini tekshirish
     member = db.query(Member).filter(Member.member_id == borrowing.member_id).first()
     if not member:
@@ -178,7 +213,7 @@ async def create_borrowing(
     # To'lanmagan jarimalar tekshiruvi
     unpaid_penalties = db.query(func.sum(Penalty.amount)).filter(
         Penalty.member_id == borrowing.member_id,
-        Penalty.status == 'unpaid'
+        Penalty.status == PENALTY_UNPAID
     ).scalar() or 0
     
     if unpaid_penalties > 0:
@@ -187,6 +222,20 @@ async def create_borrowing(
             detail=f"A'zoning {unpaid_penalties} so'm to'lanmagan jarimasi bor"
         )
     
+    # Nusxani atomik kamaytirish (tekshiruv va kamaytirish bitta UPDATE da,
+    # parallel so'rovlar available_copies ni manfiyga tushira olmaydi)
+    decremented = db.execute(
+        update(Book)
+        .where(Book.book_id == borrowing.book_id, Book.available_copies > 0)
+        .values(available_copies=Book.available_copies - 1)
+    ).rowcount
+    
+    if not decremented:
+        book_exists = db.query(Book.book_id).filter(Book.book_id == borrowing.book_id).first()
+        if not book_exists:
+            raise HTTPException(status_code=404, detail="Kitob topilmadi")
+        raise HTTPException(status_code=400, detail="Bu kitobning mavjud nusxalari yo'q")
+    
     # Borrowing yaratish
     due_date = date.today() + timedelta(days=borrowing.days)
     db_borrowing = Borrowing(
@@ -199,13 +248,19 @@ async def create_borrowing(
     
     db.add(db_borrowing)
     
-    # Kitob va a'zo statistikasini yangilash
-    book.available_copies -= 1
-    member.current_borrowed += 1
-    member.total_borrowed += 1
+    # A'zo statistikasini yangilash
+    db.execute(
+        update(Member)
+        .where(Member.member_id == borrowing.member_id)
+        .values(
+            current_borrowed=Member.current_borrowed + 1,
+            total_borrowed=Member.total_borrowed + 1
+        )
+    )
     
     db.commit()
     db.refresh(db_borrowing)
+    background_tasks.add_task(invalidate_stats_cache)
     
     # Email xabarnoma yuborish (background task)
     # background_tasks.add_task(send_borrow_notification, member.email, book.title, due_date)
@@ -213,9 +268,10 @@ async def create_borrowing(
     return db_borrowing
 
 @router.put("/api/borrowings/{borrow_id}/return", response_model=BorrowingResponse)
-async def return_book(
+def return_book(
     borrow_id: str,
     return_data: BorrowingReturn,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: Librarian = Depends(get_current_user)
 ):
@@ -227,7 +283,7 @@ async def return_book(
     if not borrowing:
         raise HTTPException(status_code=404, detail="Ijara topilmadi")
     
-    if borrowing.status == 'returned':
+    if borrowing.status == BORROWING_RETURNED:
         raise HTTPException(status_code=400, detail="Bu kitob allaqachon qaytarilgan")
     
     # Kechikish tekshiruvi
@@ -236,17 +292,22 @@ async def return_book(
     days_late = (today - borrowing.due_date).days if is_late else 0
     
     # Statusni yangilash
-    borrowing.status = 'returned'
+    borrowing.status = BORROWING_RETURNED
     borrowing.return_date = today
     if return_data.notes:
         borrowing.notes = return_data.notes
     
-    # Kitob va a'zo statistikasini yangilash
-    book = db.query(Book).filter(Book.book_id == borrowing.book_id).first()
-    member = db.query(Member).filter(Member.member_id == borrowing.member_id).first()
-    
-    book.available_copies += 1
-    member.current_borrowed -= 1
+    # Kitob va a'zo statistikasini yangilash (SELECT siz, bitta UPDATE bilan)
+    db.execute(
+        update(Book)
+        .where(Book.book_id == borrowing.book_id)
+        .values(available_copies=Book.available_copies + 1)
+    )
+    db.execute(
+        update(Member)
+        .where(Member.member_id == borrowing.member_id)
+        .values(current_borrowed=Member.current_borrowed - 1)
+    )
     
     # Agar kechikkan bo'lsa jarima yaratish
     if is_late:
@@ -261,29 +322,34 @@ async def return_book(
     
     db.commit()
     db.refresh(borrowing)
+    background_tasks.add_task(invalidate_stats_cache)
     
     return borrowing
 
 @router.get("/api/borrowings/late", response_model=List[BorrowingDetailResponse])
-async def get_late_borrowings(
+def get_late_borrowings(
     db: Session = Depends(get_db),
     current_user: Librarian = Depends(get_current_user)
 ):
     """Kechikkan ijaralar ro'yxati"""
-    late_borrowings = db.query(Borrowing).join(Member).join(Book).filter(
-        Borrowing.status.in_(['borrowed', 'late']),
-        Borrowing.due_date < date.today()
+    today = date.today()
+    late_borrowings = db.query(Borrowing).options(
+        joinedload(Borrowing.member),
+        joinedload(Borrowing.book)
+    ).filter(
+        Borrowing.status.in_(ACTIVE_BORROWING_STATUSES),
+        Borrowing.due_date < today
     ).all()
     
     result = []
     for b in late_borrowings:
-        days_late = (date.today() - b.due_date).days
-        result.append({
-            **b.__dict__,
-            "member_name": b.member.full_name,
-            "book_title": b.book.title,
-            "days_late": days_late
-        })
+        days_late = (today - b.due_date).days
+        result.append(orm_to_dict(
+            b,
+            member_name=b.member.full_name,
+            book_title=b.book.title,
+            days_late=days_late
+        ))
     
     return result
 
@@ -292,16 +358,16 @@ async def get_late_borrowings(
 # =====================================================
 
 @router.get("/api/penalties", response_model=List[PenaltyDetailResponse])
-async def get_penalties(
+def get_penalties(
     skip: int = 0,
     limit: int = 100,
-    status_filter: Optional[str] = None,
+    status_filter: Optional[PenaltyStatus] = None,
     member_id: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: Librarian = Depends(get_current_user)
 ):
     """Barcha jarimalar ro'yxati"""
-    query = db.query(Penalty).join(Member)
+    query = db.query(Penalty).options(joinedload(Penalty.member))
     
     if status_filter:
         query = query.filter(Penalty.status == status_filter)
@@ -313,16 +379,14 @@ async def get_penalties(
     
     result = []
     for p in penalties:
-        result.append({
-            **p.__dict__,
-            "member_name": p.member.full_name
-        })
+        result.append(orm_to_dict(p, member_name=p.member.full_name))
     
     return result
 
 @router.post("/api/penalties", response_model=PenaltyResponse, status_code=status.HTTP_201_CREATED)
-async def create_penalty(
+def create_penalty(
     penalty: PenaltyCreate,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: Librarian = Depends(get_current_user)
 ):
@@ -335,12 +399,14 @@ async def create_penalty(
     db.add(db_penalty)
     db.commit()
     db.refresh(db_penalty)
+    background_tasks.add_task(invalidate_stats_cache)
     return db_penalty
 
 @router.put("/api/penalties/{penalty_id}/pay", response_model=PenaltyResponse)
-async def pay_penalty(
+def pay_penalty(
     penalty_id: str,
     payment: PenaltyUpdate,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: Librarian = Depends(get_current_user)
 ):
@@ -349,10 +415,10 @@ async def pay_penalty(
     if not penalty:
         raise HTTPException(status_code=404, detail="Jarima topilmadi")
     
-    if penalty.status == 'paid':
+    if penalty.status == PENALTY_PAID:
         raise HTTPException(status_code=400, detail="Bu jarima allaqachon to'langan")
     
-    penalty.status = 'paid'
+    penalty.status = PENALTY_PAID
     penalty.paid_date = date.today()
     penalty.paid_amount = payment.paid_amount or penalty.amount
     if payment.notes:
@@ -360,53 +426,80 @@ async def pay_penalty(
     
     db.commit()
     db.refresh(penalty)
+    background_tasks.add_task(invalidate_stats_cache)
     return penalty
 
 # =====================================================
 # STATISTICS ENDPOINTS
 # =====================================================
 
-@router.get("/api/stats", response_model=LibraryStats)
-async def get_statistics(
-    db: Session = Depends(get_db),
-    current_user: Librarian = Depends(get_current_user)
-):
-    """Umumiy statistika"""
-    total_books = db.query(func.count(Book.book_id)).filter(Book.is_active == True).scalar()
-    total_members = db.query(func.count(Member.member_id)).filter(Member.is_active == True).scalar()
-    active_borrowings = db.query(func.count(Borrowing.borrow_id)).filter(Borrowing.status == 'borrowed').scalar()
-    late_borrowings = db.query(func.count(Borrowing.borrow_id)).filter(
-        Borrowing.status.in_(['borrowed', 'late']),
-        Borrowing.due_date < date.today()
-    ).scalar()
-    total_penalties = db.query(func.sum(Penalty.amount)).scalar() or 0
-    unpaid_penalties = db.query(func.sum(Penalty.amount)).filter(Penalty.status == 'unpaid').scalar() or 0
+# Kesh endpointga emas, ichki funksiyalarga qo'yiladi: to'g'ridan-to'g'ri
+# chaqirilganda fastapi-cache Cache-Control/ETag headerlarini qo'shmaydi,
+# aks holda brauzer keshi invalidate_stats_cache dan keyin ham eski javob beradi
+
+@cache(expire=STATS_CACHE_EXPIRE, namespace=STATS_CACHE_NAMESPACE, key_builder=stats_key_builder)
+def _library_statistics(db: Session) -> dict:
+    """Umumiy statistikani hisoblash (keshlanadi)"""
+    today = date.today()
+    # Barcha ko'rsatkichlar bitta so'rovda (har biri scalar subquery)
+    stats = db.query(
+        db.query(func.count(Book.book_id)).filter(
+            Book.is_active == True
+        ).scalar_subquery().label('total_books'),
+        db.query(func.count(Member.member_id)).filter(
+            Member.is_active == True
+        ).scalar_subquery().label('total_members'),
+        db.query(func.count(Borrowing.borrow_id)).filter(
+            Borrowing.status == BORROWING_BORROWED
+        ).scalar_subquery().label('active_borrowings'),
+        db.query(func.count(Borrowing.borrow_id)).filter(
+            Borrowing.status.in_(ACTIVE_BORROWING_STATUSES),
+            Borrowing.due_date < today
+        ).scalar_subquery().label('late_borrowings'),
+        db.query(func.coalesce(func.sum(Penalty.amount), 0)).scalar_subquery().label('total_penalties'),
+        db.query(func.coalesce(func.sum(Penalty.amount), 0)).filter(
+            Penalty.status == PENALTY_UNPAID
+        ).scalar_subquery().label('unpaid_penalties')
+    ).one()
     
     return {
-        "total_books": total_books,
-        "total_members": total_members,
-        "active_borrowings": active_borrowings,
-        "late_borrowings": late_borrowings,
-        "total_penalties": float(total_penalties),
-        "unpaid_penalties": float(unpaid_penalties)
+        "total_books": stats.total_books,
+        "total_members": stats.total_members,
+        "active_borrowings": stats.active_borrowings,
+        "late_borrowings": stats.late_borrowings,
+        "total_penalties": float(stats.total_penalties),
+        "unpaid_penalties": float(stats.unpaid_penalties)
     }
 
-@router.get("/api/stats/popular-books", response_model=List[PopularBook])
-async def get_popular_books(
-    limit: int = 10,
+@router.get("/api/stats", response_model=LibraryStats)
+async def get_statistics(
     db: Session = Depends(get_db),
     current_user: Librarian = Depends(get_current_user)
 ):
-    """Eng mashhur kitoblar"""
+    """Umumiy statistika"""
+    return await _library_statistics(db=db)
+
+@cache(expire=STATS_CACHE_EXPIRE, namespace=STATS_CACHE_NAMESPACE, key_builder=stats_key_builder)
+def _popular_books(limit: int, db: Session) -> list:
+    """Eng mashhur kitoblarni hisoblash (keshlanadi)"""
+    # Avval faqat borrowings jadvalida book_id bo'yicha guruhlab TOP-N olinadi,
+    # keyin shu N ta kitob ma'lumotlari qo'shiladi
+    top_books = db.query(
+        Borrowing.book_id,
+        func.count(Borrowing.borrow_id).label('borrow_count')
+    ).group_by(Borrowing.book_id).order_by(
+        desc('borrow_count')
+    ).limit(limit).subquery()
+    
     popular = db.query(
         Book.book_id,
         Book.title,
         Book.author,
         Book.genre,
-        func.count(Borrowing.borrow_id).label('borrow_count')
-    ).join(Borrowing).group_by(
-        Book.book_id, Book.title, Book.author, Book.genre
-    ).order_by(desc('borrow_count')).limit(limit).all()
+        top_books.c.borrow_count
+    ).join(top_books, top_books.c.book_id == Book.book_id).order_by(
+        desc(top_books.c.borrow_count)
+    ).all()
     
     return [
         {
@@ -419,8 +512,17 @@ async def get_popular_books(
         for p in popular
     ]
 
+@router.get("/api/stats/popular-books", response_model=List[PopularBook])
+async def get_popular_books(
+    limit: int = 10,
+    db: Session = Depends(get_db),
+    current_user: Librarian = Depends(get_current_user)
+):
+    """Eng mashhur kitoblar"""
+    return await _popular_books(limit=limit, db=db)
+
 @router.get("/api/stats/active-members", response_model=List[ActiveMember])
-async def get_active_members(
+def get_active_members(
     limit: int = 10,
     db: Session = Depends(get_db),
     current_user: Librarian = Depends(get_current_user)
@@ -435,7 +537,7 @@ async def get_active_members(
         func.coalesce(func.sum(Penalty.amount), 0).label('total_penalties')
     ).outerjoin(Penalty, and_(
         Penalty.member_id == Member.member_id,
-        Penalty.status == 'unpaid'
+        Penalty.status == PENALTY_UNPAID
     )).group_by(
         Member.member_id,
         Member.full_name,
@@ -3,21 +3,48 @@ Kutubxona Boshqaruv Tizimi - API Tests
 pytest bilan avtomatik testlar
 """
 
+import asyncio
 import pytest
+from contextlib import contextmanager
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 from datetime import date, timedelta
 
 from main import app
 from database import Base, get_db
 from models import *
-from auth import get_password_hash
-
-# Test database
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+from auth import get_password_hash, verify_password, argon2_hasher, create_access_token
+from utils import like_pattern, calculate_progressive_penalty, paginate, audit_listener
+from routes import invalidate_stats_cache
+import auth
+
+# Test database (xotirada, barcha so'rovlar bitta ulanishni ishlatadi;
+# pytest-xdist da har bir worker jarayoni alohida baza oladi)
+SQLALCHEMY_DATABASE_URL = "sqlite+pysqlite:///:memory:"
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool
+)
+
+# pysqlite SAVEPOINT larni to'g'ri ishlatishi uchun BEGIN ni o'zimiz yuboramiz
+@event.listens_for(engine, "connect")
+def _disable_pysqlite_transactions(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+@event.listens_for(engine, "begin")
+def _emit_begin(conn):
+    conn.exec_driver_sql("BEGIN")
+
+# Barcha sessiyalar bitta tashqi tranzaksiyaga SAVEPOINT orqali qo'shiladi
+# (bind `connection` fixture ichida beriladi)
+TestingSessionLocal = sessionmaker(
+    autocommit=False,
+    autoflush=False,
+    join_transaction_mode="create_savepoint"
+)
 
 # Dependency override
 def override_get_db():
@@ -27,34 +54,104 @@ def override_get_db():
     finally:
         db.close()
 
-app.dependency_overrides[get_db] = override_get_db
+_TRANSACTION_STATEMENTS = ("BEGIN", "SAVEPOINT", "RELEASE", "ROLLBACK", "COMMIT")
 
-# Test client
+@contextmanager
+def count_queries(conn):
+    """
+    Blok ichida bazaga yuborilgan SQL so'rovlar sonini sanash
+    (N+1 regressiyalarini ushlash uchun)
+    """
+    counter = {"count": 0}
+    
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # Test izolyatsiyasidagi SAVEPOINT/ROLLBACK lar hisobga olinmaydi
+        if not statement.lstrip().upper().startswith(_TRANSACTION_STATEMENTS):
+            counter["count"] += 1
+    
+    event.listen(conn, "before_cursor_execute", _before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(conn, "before_cursor_execute", _before_cursor_execute)
+
+# Test client (ilova bir marta import qilinadi, startup qayta ishga tushmaydi)
 client = TestClient(app)
 
 # =====================================================
 # FIXTURES
 # =====================================================
 
-@pytest.fixture(scope="module")
+@pytest.fixture(scope="session", autouse=True)
+def fast_password_hashing():
+    """
+    Testlarda bcrypt ning minimal narxi (4) - hash ~1ms, login tezlashadi
+    Sessiya oxirida asl qiymat qaytariladi
+    """
+    mp = pytest.MonkeyPatch()
+    mp.setattr(auth, "BCRYPT_ROUNDS", 4)
+    yield
+    mp.undo()
+
+@pytest.fixture(scope="session", autouse=True)
+def audit_log():
+    """
+    Audit log navbatini chiqaruvchi oqim
+    (TestClient context manager siz ishlatiladi - startup event lar ishlamaydi)
+    """
+    audit_listener.start()
+    yield
+    audit_listener.stop()
+
+@pytest.fixture(scope="session")
 def setup_database():
-    """Test uchun database yaratish"""
+    """Test uchun database yaratish (butun test sessiyasi uchun bir marta)"""
     Base.metadata.create_all(bind=engine)
     yield
     Base.metadata.drop_all(bind=engine)
 
+@pytest.fixture(scope="session")
+def connection(setup_database):
+    """
+    Butun sessiya uchun bitta ulanish va tashqi tranzaksiya
+    Oxirida rollback qilinadi - testlar bazaga hech narsa yozmaydi
+    """
+    conn = engine.connect()
+    transaction = conn.begin()
+    TestingSessionLocal.configure(bind=conn)
+    app.dependency_overrides[get_db] = override_get_db
+    yield conn
+    app.dependency_overrides.clear()
+    transaction.rollback()
+    conn.close()
+
+@pytest.fixture(autouse=True)
+def isolated_transaction(connection):
+    """
+    Har bir test o'z SAVEPOINT ida ishlaydi va oxirida rollback qilinadi
+    (API so'rovlari ham shu ulanishdan foydalanadi)
+    """
+    savepoint = connection.begin_nested()
+    yield
+    savepoint.rollback()
+
 @pytest.fixture
-def db_session():
-    """Database session"""
+def db_session(isolated_transaction):
+    """
+    Database session
+    Test ma'lumotlari commit emas, flush qilinadi - API so'rovlari ularni
+    shu ulanish orqali ko'radi, oxirida esa hammasi rollback bo'ladi
+    """
     db = TestingSessionLocal()
     try:
         yield db
     finally:
         db.close()
 
-@pytest.fixture
-def admin_token(db_session):
-    """Admin token yaratish"""
+@pytest.fixture(scope="session")
+def admin_token(connection):
+    """Admin token yaratish (sessiya uchun bir marta - bcrypt bir marta ishlaydi)"""
+    db = TestingSessionLocal()
     # Admin yaratish
     admin = Librarian(
         full_name="Test Admin",
@@ -63,8 +160,9 @@ def admin_token(db_session):
         role="admin",
         shift="morning"
     )
-    db_session.add(admin)
-    db_session.commit()
+    db.add(admin)
+    db.commit()
+    db.close()
     
     # Login
     response = client.post(
@@ -83,7 +181,7 @@ def test_member(db_session):
         address="Test address"
     )
     db_session.add(member)
-    db_session.commit()
+    db_session.flush()
     db_session.refresh(member)
     return member
 
@@ -101,7 +199,7 @@ def test_book(db_session):
         available_copies=5
     )
     db_session.add(book)
-    db_session.commit()
+    db_session.flush()
     db_session.refresh(book)
     return book
 
@@ -119,7 +217,7 @@ def test_login_success(setup_database, db_session):
         role="admin"
     )
     db_session.add(admin)
-    db_session.commit()
+    db_session.flush()
     
     # Login
     response = client.post(
@@ -140,6 +238,14 @@ def test_login_invalid_credentials(setup_database):
     )
     assert response.status_code == 401
 
+def test_verify_password_schemes():
+    """bcrypt va argon2 hashlari prefiks bo'yicha tekshiriladi"""
+    assert verify_password("secret", get_password_hash("secret"))
+    
+    argon2_hash = argon2_hasher.hash("secret")
+    assert verify_password("secret", argon2_hash)
+    assert not verify_password("wrong", argon2_hash)
+
 def test_get_current_user(setup_database, admin_token):
     """Joriy foydalanuvchi ma'lumotlari"""
     response = client.get(
@@ -164,6 +270,27 @@ def test_get_books(setup_database, admin_token):
     assert response.status_code == 200
     assert isinstance(response.json(), list)
 
+def test_get_books_total_count(setup_database, admin_token, test_book):
+    """Kitoblar umumiy soni X-Total-Count headerida"""
+    response = client.get(
+        "/api/books?limit=1",
+        headers={"Authorization": f"Bearer {admin_token}"}
+    )
+    assert response.status_code == 200
+    assert len(response.json()) == 1
+    total = int(response.headers["X-Total-Count"])
+    assert total >= 1
+    
+    # Faqat son (limit=0) va oxirgi sahifadan keyingi sahifa ham umumiy sonni beradi
+    for params in ("limit=0", f"skip={total}&limit=10"):
+        response = client.get(
+            f"/api/books?{params}",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        assert response.json() == []
+        assert int(response.headers["X-Total-Count"]) == total
+
 def test_create_book(setup_database, admin_token):
     """Yangi kitob yaratish"""
     book_data = {
@@ -197,6 +324,24 @@ def test_search_books(setup_database, admin_token, test_book):
     books = response.json()
     assert len(books) > 0
 
+def test_search_short_term_matches_prefix_only(setup_database, admin_token, db_session):
+    """3 belgidan qisqa so'z faqat boshidan qidiriladi"""
+    db_session.add(Book(title="War and Peace", author="Tolstoy", total_copies=1, available_copies=1))
+    db_session.flush()
+    
+    def titles(term):
+        response = client.get(
+            "/api/books",
+            params={"search": term},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        return [b["title"] for b in response.json()]
+    
+    assert "War and Peace" in titles("Wa")
+    assert "War and Peace" not in titles("ar")
+    assert "War and Peace" in titles("and")
+
 def test_update_book(setup_database, admin_token, test_book):
     """Kitob yangilash"""
     update_data = {"total_copies": 10}
@@ -224,6 +369,26 @@ def test_get_members(setup_database, admin_token):
     assert response.status_code == 200
     assert isinstance(response.json(), list)
 
+def test_get_member_detail(setup_database, admin_token, test_member, db_session):
+    """A'zo tafsilotlari ijaralar va jarimalar ro'yxati bilan"""
+    db_session.add(Penalty(
+        member_id=test_member.member_id,
+        amount=5000,
+        reason="Test",
+        status="unpaid"
+    ))
+    db_session.flush()
+    
+    response = client.get(
+        f"/api/members/{test_member.member_id}",
+        headers={"Authorization": f"Bearer {admin_token}"}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["email"] == test_member.email
+    assert data["borrowings"] == []
+    assert len(data["penalties"]) == 1
+
 def test_create_member(setup_database, admin_token):
     """Yangi a'zo yaratish"""
     member_data = {
@@ -291,7 +456,7 @@ def test_borrow_unavailable_book(setup_database, admin_token, test_member, db_se
         available_copies=0
     )
     db_session.add(book)
-    db_session.commit()
+    db_session.flush()
     
     borrow_data = {
         "member_id": str(test_member.member_id),
@@ -318,7 +483,7 @@ def test_return_book(setup_database, admin_token, test_member, test_book, db_ses
     )
     db_session.add(borrowing)
     test_book.available_copies -= 1
-    db_session.commit()
+    db_session.flush()
     
     # Qaytarish
     response = client.put(
@@ -342,7 +507,7 @@ def test_late_return_creates_penalty(setup_database, admin_token, test_member, t
         status="borrowed"
     )
     db_session.add(borrowing)
-    db_session.commit()
+    db_session.flush()
     
     # Qaytarish
     response = client.put(
@@ -372,6 +537,23 @@ def test_get_penalties(setup_database, admin_token):
     assert response.status_code == 200
     assert isinstance(response.json(), list)
 
+def test_status_filter_rejects_unknown_value(setup_database, admin_token):
+    """Noma'lum status filtri 422 qaytaradi (bazaga yetib bormaydi)"""
+    for url in ("/api/penalties", "/api/borrowings"):
+        response = client.get(
+            url,
+            params={"status_filter": "foo"},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 422
+    
+    response = client.get(
+        "/api/penalties",
+        params={"status_filter": "unpaid"},
+        headers={"Authorization": f"Bearer {admin_token}"}
+    )
+    assert response.status_code == 200
+
 def test_pay_penalty(setup_database, admin_token, test_member, db_session):
     """Jarimani to'lash"""
     # Jarima yaratish
@@ -382,7 +564,7 @@ def test_pay_penalty(setup_database, admin_token, test_member, db_session):
         status="unpaid"
     )
     db_session.add(penalty)
-    db_session.commit()
+    db_session.flush()
     
     # To'lash
     response = client.put(
@@ -412,6 +594,24 @@ def test_get_statistics(setup_database, admin_token):
     assert "total_members" in data
     assert "active_borrowings" in data
 
+def test_stats_cache_invalidated_on_new_book(setup_database, admin_token):
+    """Statistika server keshida, lekin brauzer keshiga berilmaydi va kitob qo'shilganda yangilanadi"""
+    headers = {"Authorization": f"Bearer {admin_token}"}
+    # Kesh jarayon uchun global - oldingi testlarning (rollback qilingan) qiymatlari qolmasin
+    asyncio.run(invalidate_stats_cache())
+    before = client.get("/api/stats", headers=headers)
+    assert "cache-control" not in before.headers
+    assert "etag" not in before.headers
+    
+    client.post(
+        "/api/books",
+        json={"title": "Stats Book", "author": "Author", "total_copies": 1},
+        headers=headers
+    )
+    
+    after = client.get("/api/stats", headers=headers)
+    assert after.json()["total_books"] == before.json()["total_books"] + 1
+
 def test_get_popular_books(setup_database, admin_token):
     """Mashhur kitoblar"""
     response = client.get(
@@ -422,6 +622,57 @@ def test_get_popular_books(setup_database, admin_token):
     assert response.status_code == 200
     assert isinstance(response.json(), list)
 
+# =====================================================
+# QUERY BUDGET TESTS
+# =====================================================
+
+def test_books_list_query_budget(connection, admin_token, test_book):
+    """Kitoblar ro'yxati kitoblar soniga bog'liq bo'lmagan so'rovlar bilan"""
+    with count_queries(connection) as queries:
+        response = client.get(
+            "/api/books",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+    
+    assert response.status_code == 200
+    assert queries["count"] <= 2
+
+def test_borrowings_list_query_budget(connection, admin_token, test_member, test_book):
+    """Ijaralar ro'yxati a'zo va kitoblarni alohida so'rovlarsiz yuklaydi"""
+    for _ in range(2):
+        client.post(
+            "/api/borrowings",
+            json={
+                "member_id": str(test_member.member_id),
+                "book_id": str(test_book.book_id),
+                "days": 14
+            },
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+    
+    with count_queries(connection) as queries:
+        response = client.get(
+            "/api/borrowings",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+    
+    assert response.status_code == 200
+    assert len(response.json()) >= 2
+    assert queries["count"] <= 2
+
+def test_stats_query_budget(connection, admin_token):
+    """Statistika (kesh bo'sh bo'lganda ham) bir necha so'rovda"""
+    asyncio.run(invalidate_stats_cache())
+    
+    with count_queries(connection) as queries:
+        response = client.get(
+            "/api/stats",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+    
+    assert response.status_code == 200
+    assert queries["count"] <= 3
+
 # =====================================================
 # AUTHORIZATION TESTS
 # =====================================================
@@ -439,6 +690,32 @@ def test_invalid_token():
     )
     assert response.status_code == 401
 
+def test_demoted_admin_rejected(setup_database, test_book, db_session):
+    """Admin huquqi olib tashlansa eski token bilan admin operatsiyasi bajarilmaydi"""
+    librarian = Librarian(
+        full_name="Former Admin",
+        email="former.admin@test.com",
+        password_hash="-",
+        role="admin",
+        shift="morning"
+    )
+    db_session.add(librarian)
+    db_session.flush()
+    token = create_access_token(data={
+        "sub": str(librarian.librarian_id),
+        "role": "admin",
+        "full_name": librarian.full_name
+    })
+    
+    librarian.role = "librarian"
+    db_session.flush()
+    
+    response = client.delete(
+        f"/api/books/{test_book.book_id}",
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    assert response.status_code == 403
+
 # =====================================================
 # VALIDATION TESTS
 # =====================================================
@@ -474,6 +751,38 @@ def test_create_member_invalid_email(setup_database, admin_token):
     
     assert response.status_code == 422
 
+def test_like_pattern_escapes_wildcards():
+    """Qidiruvdagi % va _ belgilari oddiy belgi sifatida qidiriladi"""
+    assert like_pattern("50%_off") == "%50\\%\\_off%"
+    assert like_pattern("ab") == "ab%"
+
+def test_paginate_keyset(db_session):
+    """Keyset sahifalash kursor bo'yicha davom etadi"""
+    db_session.add_all([
+        Book(title=f"Keyset {i}", author="Author", total_copies=1, available_copies=1)
+        for i in range(3)
+    ])
+    db_session.flush()
+    
+    query = db_session.query(Book).filter(Book.title.like("Keyset%"))
+    first = paginate(query, Book.book_id, per_page=2)
+    assert len(first["items"]) == 2 and first["has_more"]
+    
+    second = paginate(query, Book.book_id, after=first["next_cursor"], per_page=2)
+    assert len(second["items"]) == 1
+    assert not second["has_more"] and second["next_cursor"] is None
+    
+    seen = {b.book_id for b in first["items"] + second["items"]}
+    assert len(seen) == 3
+
+def test_progressive_penalty_tiers():
+    """Progressiv jarima bosqich chegaralarida"""
+    assert calculate_progressive_penalty(0) == 0
+    assert calculate_progressive_penalty(7) == 21000
+    assert calculate_progressive_penalty(8) == 26000
+    assert calculate_progressive_penalty(30) == 168000
+    assert calculate_progressive_penalty(31) == 178000
+
 # =====================================================
 # EDGE CASES
 # =====================================================
@@ -488,7 +797,7 @@ def test_borrow_with_unpaid_penalties(setup_database, admin_token, test_member,
         status="unpaid"
     )
     db_session.add(penalty)
-    db_session.commit()
+    db_session.flush()
     
     # Kitob olishga urinish
     borrow_data = {
@@ -506,4 +815,6 @@ def test_borrow_with_unpaid_penalties(setup_database, admin_token, test_member,
     assert response.status_code == 400
 
 # Testlarni ishga tushirish:
-# pytest test_api.py -v
\ No newline at end of file
+# pytest test_api.py -v
+# Parallel (har bir worker o'z :memory: bazasiga ega):
+# pytest test_api.py -n auto
\ No newline at end of file
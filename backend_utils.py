@@ -3,12 +3,39 @@ Yordamchi funksiyalar
 Email, validation, date processing va boshqalar
 """
 
-from datetime import date, datetime, timedelta
-from typing import Optional, List
+from datetime import date, timedelta
+from typing import Optional, List, Literal
+from bisect import bisect_left
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+import logging
+import queue
 import re
-from sqlalchemy.orm import Session
+from sqlalchemy import case, func, inspect
+from sqlalchemy.orm import Session, raiseload
 from models import Borrowing, Penalty, Member, Book
 
+# =====================================================
+# STATUS QIYMATLARI (db_schema.sql dagi ENUM turlari bilan bir xil)
+# =====================================================
+
+BORROWING_BORROWED = 'borrowed'
+BORROWING_RETURNED = 'returned'
+BORROWING_LATE = 'late'
+BORROWING_LOST = 'lost'
+BORROWING_STATUSES = (BORROWING_BORROWED, BORROWING_RETURNED, BORROWING_LATE, BORROWING_LOST)
+# Hali qaytarilmagan ijaralar (idx_borrowings_active partial index sharti)
+ACTIVE_BORROWING_STATUSES = (BORROWING_BORROWED, BORROWING_LATE)
+
+PENALTY_PAID = 'paid'
+PENALTY_UNPAID = 'unpaid'
+PENALTY_WAIVED = 'waived'
+PENALTY_STATUSES = (PENALTY_PAID, PENALTY_UNPAID, PENALTY_WAIVED)
+
+# Query parametrlari uchun: noma'lum qiymat ENUM cast gacha yetmaydi (422)
+BorrowingStatus = Literal[BORROWING_STATUSES]
+PenaltyStatus = Literal[PENALTY_STATUSES]
+
 # =====================================================
 # DATE UTILITIES
 # =====================================================
@@ -62,6 +89,11 @@ def calculate_late_penalty(days_late: int, rate_per_day: float = 5000) -> float:
     """
     return days_late * rate_per_day
 
+# Progressiv jarima bosqichlari: boshlanish kuni, oldingi bosqichlar summasi, kunlik stavka
+_PENALTY_TIER_STARTS = (0, 7, 14, 30)
+_PENALTY_TIER_BASES = (0, 7 * 3000, 7 * 3000 + 7 * 5000, 7 * 3000 + 7 * 5000 + 16 * 7000)
+_PENALTY_TIER_RATES = (3000, 5000, 7000, 10000)
+
 def calculate_progressive_penalty(days_late: int) -> float:
     """
     Progressiv jarima (uzoq kechikishlar uchun yuqori stavka)
@@ -70,32 +102,12 @@ def calculate_progressive_penalty(days_late: int) -> float:
     15-30 kun: 7000 so'm/kun
     30+ kun: 10000 so'm/kun
     """
-    penalty = 0.0
-    remaining_days = days_late
+    if days_late <= 0:
+        return 0.0
     
-    # 1-7 kunlar
-    if remaining_days > 0:
-        days = min(remaining_days, 7)
-        penalty += days * 3000
-        remaining_days -= days
-    
-    # 8-14 kunlar
-    if remaining_days > 0:
-        days = min(remaining_days, 7)
-        penalty += days * 5000
-        remaining_days -= days
-    
-    # 15-30 kunlar
-    if remaining_days > 0:
-        days = min(remaining_days, 16)
-        penalty += days * 7000
-        remaining_days -= days
-    
-    # 30+ kunlar
-    if remaining_days > 0:
-        penalty += remaining_days * 10000
-    
-    return penalty
+    tier = bisect_left(_PENALTY_TIER_STARTS, days_late) - 1
+    extra_days = days_late - _PENALTY_TIER_STARTS[tier]
+    return float(_PENALTY_TIER_BASES[tier] + extra_days * _PENALTY_TIER_RATES[tier])
 
 def apply_first_time_discount(
     db: Session, 
@@ -114,7 +126,7 @@ def apply_first_time_discount(
     # Oldingi jarimalar bormi?
     previous_count = db.query(Penalty).filter(
         Penalty.member_id == member_id,
-        Penalty.status != 'waived'
+        Penalty.status != PENALTY_WAIVED
     ).count()
     
     if previous_count == 0:
@@ -139,16 +151,17 @@ def apply_penalty_cap(penalty: float, book_value: float, cap_percent: float = 0.
 # VALIDATION
 # =====================================================
 
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+# Format: +998901234567 yoki 901234567
+_PHONE_RE = re.compile(r'^(\+998)?[0-9]{9}$')
+
 def validate_email(email: str) -> bool:
     """Email formatini tekshirish"""
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return _EMAIL_RE.match(email) is not None
 
 def validate_phone(phone: str) -> bool:
     """Telefon raqam formatini tekshirish (O'zbekiston)"""
-    # Format: +998901234567 yoki 901234567
-    pattern = r'^(\+998)?[0-9]{9}$'
-    return re.match(pattern, phone) is not None
+    return _PHONE_RE.match(phone) is not None
 
 def validate_isbn(isbn: str) -> bool:
     """ISBN formatini tekshirish"""
@@ -170,33 +183,43 @@ def can_borrow_book(
     Returns:
         tuple: (can_borrow: bool, error_message: Optional[str])
     """
+    # A'zo, kitob va jarimalar holati bitta so'rovda (har biri scalar subquery)
+    member_filter = Member.member_id == member_id
+    book_filter = Book.book_id == book_id
+    row = db.query(
+        db.query(Member).filter(member_filter).exists().label('member_exists'),
+        db.query(Member.is_active).filter(member_filter).scalar_subquery().label('member_active'),
+        db.query(Member.current_borrowed).filter(member_filter).scalar_subquery().label('current_borrowed'),
+        db.query(Book).filter(book_filter).exists().label('book_exists'),
+        db.query(Book.is_active).filter(book_filter).scalar_subquery().label('book_active'),
+        db.query(Book.available_copies).filter(book_filter).scalar_subquery().label('available_copies'),
+        db.query(func.count(Penalty.penalty_id)).filter(
+            Penalty.member_id == member_id,
+            Penalty.status == PENALTY_UNPAID
+        ).scalar_subquery().label('unpaid_penalties')
+    ).one()
+    
     # A'zo mavjudmi va faolmi?
-    member = db.query(Member).filter(Member.member_id == member_id).first()
-    if not member:
+    if not row.member_exists:
         return False, "A'zo topilmadi"
-    if not member.is_active:
+    if not row.member_active:
         return False, "A'zo faol emas"
     
     # Kitob mavjudmi?
-    book = db.query(Book).filter(Book.book_id == book_id).first()
-    if not book:
+    if not row.book_exists:
         return False, "Kitob topilmadi"
-    if not book.is_active:
+    if not row.book_active:
         return False, "Kitob faol emas"
-    if book.available_copies <= 0:
+    if row.available_copies <= 0:
         return False, "Kitob mavjud emas"
     
     # To'lanmagan jarimalar bormi?
-    unpaid_penalties = db.query(Penalty).filter(
-        Penalty.member_id == member_id,
-        Penalty.status == 'unpaid'
-    ).count()
-    if unpaid_penalties > 0:
-        return False, f"A'zoning {unpaid_penalties} ta to'lanmagan jarimasi bor"
+    if row.unpaid_penalties > 0:
+        return False, f"A'zoning {row.unpaid_penalties} ta to'lanmagan jarimasi bor"
     
     # Maksimal kitoblar soni (masalan, 5 ta)
     MAX_CONCURRENT_BOOKS = 5
-    if member.current_borrowed >= MAX_CONCURRENT_BOOKS:
+    if row.current_borrowed >= MAX_CONCURRENT_BOOKS:
         return False, f"A'zo maksimal {MAX_CONCURRENT_BOOKS} ta kitobgacha ola oladi"
     
     return True, None
@@ -211,33 +234,25 @@ def get_member_statistics(db: Session, member_id: str) -> dict:
     if not member:
         return {}
     
-    # Jarimalar
-    total_penalties = db.query(Penalty).filter(
-        Penalty.member_id == member_id
-    ).count()
-    
-    unpaid_penalties = db.query(Penalty).filter(
-        Penalty.member_id == member_id,
-        Penalty.status == 'unpaid'
-    ).count()
-    
-    total_penalty_amount = db.query(func.sum(Penalty.amount)).filter(
+    # Jarimalar (bitta so'rovda: soni, to'lanmaganlar soni, summa)
+    total_penalties, unpaid_penalties, total_penalty_amount = db.query(
+        func.count(Penalty.penalty_id),
+        func.count(case((Penalty.status == PENALTY_UNPAID, 1))),
+        func.coalesce(func.sum(Penalty.amount), 0)
+    ).filter(
         Penalty.member_id == member_id
-    ).scalar() or 0
-    
-    # Kechikkanlar
-    late_returns = db.query(Borrowing).filter(
-        Borrowing.member_id == member_id,
-        Borrowing.status == 'late'
-    ).count()
+    ).one()
     
-    # O'rtacha ijara muddati
-    avg_borrow_days = db.query(
-        func.avg(func.extract('day', Borrowing.return_date - Borrowing.borrow_date))
+    # Ijaralar (bitta so'rovda: kechikkanlar soni, o'rtacha ijara muddati)
+    late_returns, avg_borrow_days = db.query(
+        func.count(case((Borrowing.status == BORROWING_LATE, 1))),
+        func.avg(case((
+            Borrowing.status == BORROWING_RETURNED,
+            func.extract('day', Borrowing.return_date - Borrowing.borrow_date)
+        )))
     ).filter(
-        Borrowing.member_id == member_id,
-        Borrowing.status == 'returned'
-    ).scalar() or 0
+        Borrowing.member_id == member_id
+    ).one()
     
     return {
         "member_id": str(member_id),
@@ -248,7 +263,7 @@ def get_member_statistics(db: Session, member_id: str) -> dict:
         "unpaid_penalties": unpaid_penalties,
         "total_penalty_amount": float(total_penalty_amount),
         "late_returns": late_returns,
-        "average_borrow_days": float(avg_borrow_days),
+        "average_borrow_days": float(avg_borrow_days or 0),
         "registration_date": member.registration_date.isoformat()
     }
 
@@ -256,6 +271,29 @@ def get_member_statistics(db: Session, member_id: str) -> dict:
 # SEARCH & FILTER
 # =====================================================
 
+LIKE_ESCAPE = '\\'
+# Bundan qisqa so'zlar faqat boshidan qidiriladi: "ar" -> "ar%" ("War and Peace" topilmaydi).
+# pg_trgm GIN indekslari 3 belgidan qisqa '%..%' pattern uchun deyarli foydasiz;
+# boshlanishi bog'langan pattern esa shu GIN indekslar orqali tanlab qidiriladi
+# (idx_books_title/idx_books_author oddiy B-tree - ILIKE ulardan foydalanmaydi)
+SHORT_SEARCH_LENGTH = 3
+
+def like_pattern(term: str) -> str:
+    """
+    Qidiruv so'zidan LIKE pattern yasash
+    %, _ va \\ belgilari ekranlanadi (LIKE_ESCAPE bilan ishlatiladi)
+    SHORT_SEARCH_LENGTH dan qisqa so'zlar faqat boshidan moslanadi ("ab%"),
+    uzunroqlari matnning istalgan joyidan ("%abc%")
+    """
+    escaped = (
+        term.replace(LIKE_ESCAPE, LIKE_ESCAPE * 2)
+        .replace('%', LIKE_ESCAPE + '%')
+        .replace('_', LIKE_ESCAPE + '_')
+    )
+    if len(term) < SHORT_SEARCH_LENGTH:
+        return f"{escaped}%"
+    return f"%{escaped}%"
+
 def search_books(
     db: Session,
     query: str,
@@ -266,14 +304,14 @@ def search_books(
     """
     Kitoblarni qidirish (title, author, ISBN)
     """
-    search_pattern = f"%{query}%"
+    search_pattern = like_pattern(query)
     
     filters = [
         Book.is_active == True,
         (
-            Book.title.ilike(search_pattern) |
-            Book.author.ilike(search_pattern) |
-            Book.isbn.ilike(search_pattern)
+            Book.title.ilike(search_pattern, escape=LIKE_ESCAPE) |
+            Book.author.ilike(search_pattern, escape=LIKE_ESCAPE) |
+            Book.isbn.ilike(search_pattern, escape=LIKE_ESCAPE)
         )
     ]
     
@@ -283,7 +321,8 @@ def search_books(
     if available_only:
         filters.append(Book.available_copies > 0)
     
-    books = db.query(Book).filter(*filters).limit(limit).all()
+    # Natijada relationship lar ishlatilmaydi - lazy load (N+1) bo'lsa xatolik
+    books = db.query(Book).options(raiseload('*')).filter(*filters).limit(limit).all()
     return books
 
 def search_members(
@@ -295,20 +334,20 @@ def search_members(
     """
     A'zolarni qidirish (name, email, phone)
     """
-    search_pattern = f"%{query}%"
+    search_pattern = like_pattern(query)
     
     filters = [
         (
-            Member.full_name.ilike(search_pattern) |
-            Member.email.ilike(search_pattern) |
-            Member.phone.ilike(search_pattern)
+            Member.full_name.ilike(search_pattern, escape=LIKE_ESCAPE) |
+            Member.email.ilike(search_pattern, escape=LIKE_ESCAPE) |
+            Member.phone.ilike(search_pattern, escape=LIKE_ESCAPE)
         )
     ]
     
     if active_only:
         filters.append(Member.is_active == True)
     
-    members = db.query(Member).filter(*filters).limit(limit).all()
+    members = db.query(Member).options(raiseload('*')).filter(*filters).limit(limit).all()
     return members
 
 # =====================================================
@@ -321,6 +360,7 @@ def format_currency(amount: float) -> str:
     """
     return f"{amount:,.0f} so'm"
 
+@lru_cache(maxsize=4096)
 def format_phone(phone: str) -> str:
     """
     Telefon raqamni formatlash
@@ -331,18 +371,18 @@ def format_phone(phone: str) -> str:
     
     return f"+998 {phone[:2]} {phone[2:5]} {phone[5:7]} {phone[7:]}"
 
+# Oy nomlari (date.month - 1 indeksi bo'yicha)
+_UZ_MONTHS = (
+    'yanvar', 'fevral', 'mart', 'aprel', 'may', 'iyun',
+    'iyul', 'avgust', 'sentabr', 'oktabr', 'noyabr', 'dekabr'
+)
+
 def format_date_uz(date_obj: date) -> str:
     """
     Sanani o'zbek formatida ko'rsatish
     2024-01-15 -> "15-yanvar-2024"
     """
-    months = {
-        1: 'yanvar', 2: 'fevral', 3: 'mart', 4: 'aprel',
-        5: 'may', 6: 'iyun', 7: 'iyul', 8: 'avgust',
-        9: 'sentabr', 10: 'oktabr', 11: 'noyabr', 12: 'dekabr'
-    }
-    
-    return f"{date_obj.day}-{months[date_obj.month]}-{date_obj.year}"
+    return f"{date_obj.day}-{_UZ_MONTHS[date_obj.month - 1]}-{date_obj.year}"
 
 # =====================================================
 # NOTIFICATIONS (stub - email/SMS uchun)
@@ -378,6 +418,17 @@ async def send_overdue_notification(
 # LOGGING
 # =====================================================
 
+# So'rov oqimi faqat navbatga yozadi, chiqarish alohida oqimda (QueueListener)
+_log_queue = queue.SimpleQueue()
+audit_logger = logging.getLogger("library.audit")
+audit_logger.setLevel(logging.INFO)
+audit_logger.addHandler(QueueHandler(_log_queue))
+audit_logger.propagate = False
+_audit_handler = logging.StreamHandler()
+_audit_handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s"))
+# Ilova (main) startup/shutdown da start()/stop() qilinadi
+audit_listener = QueueListener(_log_queue, _audit_handler)
+
 def log_action(
     action: str,
     user_id: str,
@@ -387,24 +438,75 @@ def log_action(
     Foydalanuvchi harakatlarini loglash
     (Audit trail uchun)
     """
-    timestamp = datetime.now().isoformat()
-    print(f"[{timestamp}] {action} by {user_id}: {details}")
+    audit_logger.info("%s by %s: %s", action, user_id, details)
+
+# =====================================================
+# SERIALIZATION
+# =====================================================
+
+@lru_cache(maxsize=None)
+def _column_keys(model_cls) -> frozenset:
+    """Model ustunlari nomlari (har bir klass uchun bir marta hisoblanadi)"""
+    return frozenset(attr.key for attr in inspect(model_cls).column_attrs)
+
+def orm_to_dict(obj, **extra) -> dict:
+    """
+    ORM obyektining yuklangan qiymatlarini dict ko'rinishida olish
+    (_sa_instance_state qo'shilmaydi, extra maydonlar ustiga yoziladi)
+    """
+    # __dict__ nusxasi C darajasida - ustunlarni birma-bir o'qishdan tezroq
+    data = obj.__dict__.copy()
+    data.pop('_sa_instance_state', None)
+    
+    # commit dan keyin expire bo'lgan yoki deferred ustunlar __dict__ da yo'q
+    keys = _column_keys(type(obj))
+    if not keys <= data.keys():
+        for key in keys - data.keys():
+            data[key] = getattr(obj, key)
+    
+    data.update(extra)
+    return data
 
 # =====================================================
 # PAGINATION
 # =====================================================
 
-def paginate(query, page: int = 1, per_page: int = 50):
+def fetch_page(query, skip: int = 0, limit: int = 100) -> tuple[list, int]:
+    """
+    Sahifa va umumiy sonni bitta so'rovda olish (COUNT(*) OVER())
+    Returns:
+        tuple: (items, total)
+    """
+    # limit=0 - faqat umumiy son so'ralgan
+    if limit <= 0:
+        return [], query.count()
+    
+    rows = query.add_columns(func.count().over().label('total')).offset(skip).limit(limit).all()
+    if rows:
+        return [row[0] for row in rows], rows[0].total
+    
+    # Oxirgi sahifadan keyin so'ralsa umumiy sonni alohida olish
+    return [], query.count() if skip else 0
+
+def paginate(query, order_col, after=None, per_page: int = 50):
     """
-    Query natijalarini sahifalash
+    Query natijalarini keyset (seek) usulida sahifalash
+    OFFSET va COUNT(*) ishlatilmaydi - har qanday sahifa birinchi sahifa kabi tez
+    
+    Args:
+        order_col: Indekslangan, unikal tartiblash ustuni (masalan, Book.book_id)
+        after: Oldingi sahifaning next_cursor qiymati
     """
-    total = query.count()
-    items = query.offset((page - 1) * per_page).limit(per_page).all()
+    if after is not None:
+        query = query.filter(order_col > after)
+    
+    # Keyingi sahifa borligini bilish uchun bitta ortiqcha qator olinadi
+    rows = query.order_by(order_col).limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    items = rows[:per_page]
     
     return {
         "items": items,
-        "total": total,
-        "page": page,
-        "per_page": per_page,
-        "pages": (total + per_page - 1) // per_page
-    }
\ No newline at end of file
+        "next_cursor": getattr(items[-1], order_col.key) if has_more else None,
+        "has_more": has_more
+    }
@@ -10,6 +10,29 @@ CREATE DATABASE library_management;
 -- UUID kengaytmasini yoqish
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
 
+-- Trigram kengaytmasi (ILIKE '%...%' qidiruvi uchun indekslar)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Status turlari (4 baytli ENUM: VARCHAR dan ixcham, indekslar kichikroq)
+-- Qiymatlar backend_utils.py dagi BORROWING_* / PENALTY_* konstantalari bilan bir xil
+CREATE TYPE borrowing_status AS ENUM ('borrowed', 'returned', 'late', 'lost');
+CREATE TYPE penalty_status AS ENUM ('paid', 'unpaid', 'waived');
+
+-- Mavjud (VARCHAR status li) bazani ko'chirish - bu fayl faqat yangi baza yaratadi.
+-- status ga bog'liq view va partial index avval o'chiriladi, keyin qayta yaratiladi:
+--   DROP VIEW IF EXISTS late_borrowings_view, active_members_view;
+--   DROP INDEX IF EXISTS idx_borrowings_active;
+--   ALTER TABLE borrowings DROP CONSTRAINT IF EXISTS borrowings_status_check,
+--       ALTER COLUMN status DROP DEFAULT,
+--       ALTER COLUMN status TYPE borrowing_status USING status::borrowing_status,
+--       ALTER COLUMN status SET DEFAULT 'borrowed';
+--   ALTER TABLE penalties DROP CONSTRAINT IF EXISTS penalties_status_check,
+--       ALTER COLUMN status DROP DEFAULT,
+--       ALTER COLUMN status TYPE penalty_status USING status::penalty_status,
+--       ALTER COLUMN status SET DEFAULT 'unpaid';
+--   -- so'ng idx_borrowings_active, late_borrowings_view va active_members_view
+--   -- ni quyidagi ta'riflar bo'yicha qayta yarating
+
 -- =====================================================
 -- 1. LIBRARIANS JADVALI (Kutubxonachilar)
 -- =====================================================
@@ -75,7 +98,7 @@ CREATE TABLE borrowings (
     borrow_date DATE DEFAULT CURRENT_DATE,
     due_date DATE NOT NULL,
     return_date DATE,
-    status VARCHAR(20) DEFAULT 'borrowed' CHECK (status IN ('borrowed', 'returned', 'late', 'lost')),
+    status borrowing_status DEFAULT 'borrowed',
     notes TEXT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
@@ -91,7 +114,7 @@ CREATE TABLE penalties (
     amount DECIMAL(10, 2) NOT NULL CHECK (amount >= 0),
     reason TEXT NOT NULL,
     issued_date DATE DEFAULT CURRENT_DATE,
-    status VARCHAR(20) DEFAULT 'unpaid' CHECK (status IN ('paid', 'unpaid', 'waived')),
+    status penalty_status DEFAULT 'unpaid',
     paid_date DATE,
     paid_amount DECIMAL(10, 2) DEFAULT 0,
     notes TEXT,
@@ -106,14 +129,29 @@ CREATE INDEX idx_members_email ON members(email);
 CREATE INDEX idx_members_active ON members(is_active);
 CREATE INDEX idx_books_title ON books(title);
 CREATE INDEX idx_books_author ON books(author);
-CREATE INDEX idx_books_genre ON books(genre);
-CREATE INDEX idx_borrowings_member ON borrowings(member_id);
+-- genre IS NOT NULL: janrlar ro'yxati (SELECT DISTINCT genre) index-only scan bilan o'qiladi
+CREATE INDEX idx_books_genre ON books(genre) WHERE genre IS NOT NULL;
+CREATE INDEX idx_books_active_available ON books(is_active, available_copies);
+-- (member_id, status): a'zo bo'yicha va a'zo+status bo'yicha filtrlar uchun
+CREATE INDEX idx_borrowings_member_status ON borrowings(member_id, status);
 CREATE INDEX idx_borrowings_book ON borrowings(book_id);
 CREATE INDEX idx_borrowings_status ON borrowings(status);
 CREATE INDEX idx_borrowings_due_date ON borrowings(due_date);
-CREATE INDEX idx_penalties_member ON penalties(member_id);
+-- Faqat aktiv ijaralar (qaytarilganlar indeksga kirmaydi, indeks kichik qoladi)
+CREATE INDEX idx_borrowings_active ON borrowings(book_id, member_id)
+    WHERE status IN ('borrowed', 'late');
+CREATE INDEX idx_penalties_member_status ON penalties(member_id, status);
 CREATE INDEX idx_penalties_status ON penalties(status);
 
+-- Qidiruv uchun trigram GIN indekslar (ILIKE '%so''z%')
+-- Har bir ustun alohida: OR bilan birlashtirilgan ILIKE lar BitmapOr orqali indeksdan foydalanadi
+CREATE INDEX idx_members_full_name_trgm ON members USING gin (full_name gin_trgm_ops);
+CREATE INDEX idx_members_email_trgm ON members USING gin (email gin_trgm_ops);
+CREATE INDEX idx_members_phone_trgm ON members USING gin (phone gin_trgm_ops);
+CREATE INDEX idx_books_title_trgm ON books USING gin (title gin_trgm_ops);
+CREATE INDEX idx_books_author_trgm ON books USING gin (author gin_trgm_ops);
+CREATE INDEX idx_books_isbn_trgm ON books USING gin (isbn gin_trgm_ops);
+
 -- =====================================================
 -- TRIGGER FUNKSIYALAR
 -- =====================================================